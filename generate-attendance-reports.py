@@ -10,6 +10,7 @@
     Version 3.0 update:  Command-line parameters
     Version 4.0 update:  Tweaks to support wider range of .csv formats generated by different versions of zoom
     Version 4.1 update:  Sort meeting-report-by-week correctly despite new year, i.e. order it oct-dec-jan-may rather than jan-dec
+    Version 5.0 update:  Use pandas to load the .csv files, rather than parsing them line by line
 
     Command line usage:
                 One or more parameters giving paths to directory containing .csv files.
@@ -60,33 +61,30 @@
 '''
 
 import numpy as np
-import csv, datetime, glob, sys
+import pandas as pd
+import csv, glob, re, sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+# Pattern matching staff email addresses: any of @glasgow.ac.uk, @research.glasgow.ac.uk, @gla.ac.uk or @research.gla.ac.uk
+staffEmailPattern = re.compile(r'@(?:research\.)?gla(?:sgow)?\.ac\.uk')
+# If you can't distinguish some or all demonstrator emails, but want to enter them manually, then
+# knownDemonstratorEmails can contain a manually-curated list of demonstrator emails
+# that would be otherwise indistinguishable from undergraduate email addresses.
+knownDemonstratorEmails = frozenset([])
 
 def StaffEmail(email):
     # Returns True if this looks like a staff email, so this can be excluded from the attendance report.
     # If staff emails are indistinguishable in format from student emails, or you don't want to bother with this,
     # just return False from this function. In that case, the worst that will happen is you'll get attendance reports
     # for staff/demonstrators as well.
-    # If you can't distinguish some or all demonstrator emails, but want to enter them manually, then
-    # knownDemonstratorEmails can contain a manually-curated list of demonstrator emails 
-    # that would be otherwise indistinguishable from undergraduate email addresses.
-    knownDemonstratorEmails = []
-    return ("@glasgow.ac.uk" in email) or           \
-           ("@research.glasgow.ac.uk" in email) or  \
-           ("@gla.ac.uk" in email) or               \
-           ("@research.gla.ac.uk" in email) or      \
-           (email in knownDemonstratorEmails)
+    return (staffEmailPattern.search(email) is not None) or (email in knownDemonstratorEmails)
 
 def UniversityStudentEmail(email):
     # Returns True if this looks like an official university student email, as opposed to a personal email address.
     # If you can't specifically distinguish student email addresses from staff, just return True for all university email addresses.
-    return "@student.gla.ac.uk" in email
-
-def date_from_isoweek(iso_year, iso_weeknumber, iso_weekday):
-    # From stackoverflow ( https://stackoverflow.com/questions/304256/whats-the-best-way-to-find-the-inverse-of-datetime-isocalendar )
-    return datetime.datetime.strptime(
-        '{:04d} {:02d} {:d}'.format(iso_year, iso_weeknumber, iso_weekday),
-        '%G %V %u').date()
+    return email.endswith("@student.gla.ac.uk")
 
 # Manually curated list of email pairs for students who I have noticed switched from personal to GU emails.
 # e.g. add entries like:
@@ -95,124 +93,126 @@ def date_from_isoweek(iso_year, iso_weeknumber, iso_weekday):
 # However, those suggestions rely on the student giving themselves a correct and clear display name
 # alongside their personal email address, so it won't always succeed in spotting pairings.
 emailMapping = { }
-reverseEmailMapping = {v: k for k, v in emailMapping.items()}
-dateFormat = '%d/%m/%Y %H:%M:%S %p'
-
-directoriesToProcess = []
-warningThreshold = 0
-processDefaultDirectory = True
-for arg in sys.argv[1:]:
-    if arg.startswith("-m"):
-        if (len(arg) == 2):
-            print("Usage: rerun with e.g. \"-m4\" to warn for students who have attended <=4 sessions")
+
+# How we combine multiple records for the same student on the same date:
+# keep the name, email and start time from the first record we encountered, and total up the minutes attended.
+entryAggregation = dict(name=('name', 'first'), email=('email', 'first'), start=('start', 'first'),
+                        weekStart=('weekStart', 'first'), mins=('mins', 'sum'))
+
+def LoadParticipantsFile(fn, dateFormat):
+    # Load one zoom participants file, and total up the attendance for each student on each date in that file.
+    # Returns that table, along with the join time of the first participant (which we report as the date of the file).
+    # Files are loaded in parallel worker processes, so this should only depend on its parameters and on emailMapping.
+    with open(fn, newline='', encoding='utf-8') as csvfile:
+        # The first row is the column headers. We only use it to see how many columns there are,
+        # which also avoids problems caused by a weird unicode character that Zoom puts at the very start of the .csv files it generates.
+        # This gets a bit fiddly because, depending on settings, Zoom may generate reports with 3, 5 or 6 columns
+        # This is an empirical effort to parse all versions I am aware of, though ideally maybe we should be
+        # parsing the column header to identify what each column represents
+        numColumns = len(next(csv.reader([csvfile.readline()])))
+        # Now read the rest of the file in one go
+        if (numColumns >= 5):
+            df = pd.read_csv(csvfile, header=None, usecols=[0, 1, 2, 4],
+                             names=['name', 'email', 'start', 'mins'],
+                             dtype={'name': str, 'email': str, 'start': str, 'mins': 'int32'},
+                             keep_default_na=False, engine='c')
         else:
-            print("Will warn for students who have attended <={0} sessions".format(arg[2:]))
-            warningThreshold = int(arg[2:])
-    elif arg == "-am":
-        print("Will expect american date formats")
-        dateFormat = '%m/%d/%Y %H:%M:%S %p'
+            df = pd.read_csv(csvfile, header=None, usecols=[0, 1, 2],
+                             names=['name', 'email', 'mins'],
+                             dtype={'name': str, 'email': str, 'mins': 'int32'},
+                             keep_default_na=False, engine='c')
+            df['start'] = fn
+
+    if (numColumns >= 5):
+        try:
+            # Many participants share the same join time, so ask pandas to parse each distinct time string only once.
+            # We keep the dates as a pandas datetime column, so that pandas can work with them directly
+            df['date'] = pd.to_datetime(df['start'], format=dateFormat, cache=True).dt.normalize()
+        except:
+            print("*** ERROR ***: parsing of date failed in file {0}. Are your dates in american format (mm/dd/yyyy)?".format(fn))
+            print("If so, rerun this script with the '-am' option")
+            print("")
+            raise
+        # Label each entry with the date of the Monday of its week (used for the by-week report)
+        df['weekStart'] = df['date'].dt.to_period('W-SUN').dt.start_time
     else:
-        processDefaultDirectory = False
-        if "*" in arg:
-            print("Warning: ignoring quoted wildcard was passed in as a command line parameter \"{0}\".".format(arg))
-            print("  That approach is not supported - use an unquoted wildcard if you want to process a batch of directories independently")
-        else:
-            directoriesToProcess.append(arg)
-
-if processDefaultDirectory:
-    print("No directories specified in command line arguments specified - processing current directory")
-    directoriesToProcess = ["."]
-
-
-for sourcePath in directoriesToProcess:
+        df['date'] = fn   # We don't have access to a date - just use the filename as a proxy for that
+        df['weekStart'] = pd.NaT   # ... and so we can't say which week these entries belong to
+
+    df['email'] = df['email'].str.lower()  # Convert to lowercase because some students seemed to change that mid-semester
+    df['key'] = df['email'].map(emailMapping).fillna(df['email'])
+    # Total up this file straight away, so we only hold on to one row per student per date
+    return (df.groupby(['key', 'date'], sort=False, as_index=False).agg(**entryAggregation), df['start'].iat[0])
+
+def WriteAttendanceTable(agg, columnKey, meta, excludedEmails, filename):
+    # Writes out a table of student name vs minutes attended, with one column for each distinct value of agg[columnKey]
+    # (e.g. each date). Students in excludedEmails are left out of the table.
+    # Missing entries are left blank in the output (hence the conversion to pandas' nullable integer type)
+    table = agg.pivot_table(index='key', columns=columnKey, values='mins', aggfunc='sum', observed=True).astype('Int64')
+    table = table.drop(excludedEmails, errors='ignore')
+    table.index = pd.MultiIndex.from_arrays([meta['name'].reindex(table.index), table.index], names=['Name', 'Email'])
+    table.to_csv(filename, chunksize=10000)
+
+
+def ProcessDirectory(sourcePath, dateFormat, warningThreshold):
+    # Loads all the participants files in one directory, and generates the attendance reports for them in that same directory
     print("\n===== Processing directory \"{0}\" =====".format(sourcePath))
-    
+
     ##########################################
     ### Load all available meeting records ###
     ##########################################
 
-    # Dictionary to accumulate all our data
-    emails = dict()
+    # List of per-file attendance totals, which we will combine once everything has been loaded
+    frames = []
 
     # List of input files to process
     filenames = glob.glob("{0}/participants*.csv".format(sourcePath))
 
-    for fn in filenames:
-        # First a quick peek to check the date in the file
-        with open(fn, newline='') as csvfile:
-            csvreader = csv.reader(csvfile, delimiter=',')
-            row1 = next(csvreader)
-            row2 = next(csvreader)
-            print('Processing file {0} (date {1})'.format(fn, row2[2]))
-        # Now process the file properly
-        with open(fn, newline='') as csvfile:
-            csvreader = csv.reader(csvfile, delimiter=',')
-            for row in csvreader:
-                if row[0].endswith('Name (Original Name)'):
-                    # Skip header row.
-                    # Note that the use of 'endswidth' avoids problems caused by a weird
-                    # unicode character that Zoom puts at the very start of the .csv files it generates.
-                    continue
-                    
-                # Parse data row
-                name = row[0]
-                email = row[1].lower()  # Convert to lowercase because some students seemed to change that mid-semester
-                if email in emailMapping:
-                    emailKey = emailMapping[email]
-                else:
-                    emailKey = email
-                # This gets a bit fiddly because, depending on settings, Zoom may generate reports with 3, 5 or 6 columns
-                # This is an empirical effort to parse all versions I am aware of, though ideally maybe we should be
-                # parsing the column header to identify what each column represents
-                if (len(row) >= 5):
-                    mins = int(row[4])
-                    start = row[2]
-                    try:
-                        date_time_obj = datetime.datetime.strptime(start, dateFormat)
-                    except:
-                        print("*** ERROR ***: parsing of date failed. Are your dates in american format (mm/dd/yyyy)?")
-                        print("If so, rerun this script with the '-am' option")
-                        print("")
-                        raise
-                    date = date_time_obj.date()
-                else:
-                    start = fn
-                    date = fn   # We don't have access to a date - just use the filename as a proxy for that
-                    mins = int(row[2])
-
-                # Create an entry if we have not encountered this student before
-                if not emailKey in emails:
-                    emails[emailKey] = dict()
-
-                if date in emails[emailKey]:
-                    # We already have an entry for this student on this date.
-                    # Add the number of minutes from the current data line we have just read
-                    emails[emailKey][date][3] += mins
-                else:
-                    # Create a new entry for this student on this date
-                    emails[emailKey][date] = [name, email, start, mins]
+    # Load the files in parallel, one worker process per file
+    with ProcessPoolExecutor() as executor:
+        results = list(executor.map(LoadParticipantsFile, filenames, repeat(dateFormat)))
+    for (fn, (table, firstStart)) in zip(filenames, results):
+        print('Processing file {0} (date {1})'.format(fn, firstStart))
+        frames.append(table)
+
+    if (len(frames) == 0):
+        print("No participants files found in directory \"{0}\"".format(sourcePath))
+        return
+
+    # Combine all the files, and total up the attendance for each student on each date
+    # (the same date may appear in more than one file)
+    df = pd.concat(frames, ignore_index=True)
+    # Store the student and date columns as categoricals (i.e. integer codes), which are much quicker to group by.
+    # Note that observed=True is needed so that pandas only generates groups for combinations that actually occur.
+    df['key'] = df['key'].astype('category')
+    df['date'] = df['date'].astype('category')
+    agg = df.groupby(['key', 'date'], sort=False, observed=True, as_index=False).agg(**entryAggregation)
+    agg = agg.sort_values(['key', 'date'])
+    # Display name and email for each student (from the first record we encountered).
+    # The reports all list students in order of email address, so we sort this once here.
+    meta = df.groupby('key', sort=False, observed=True).agg(name=('name', 'first'), email=('email', 'first')).sort_index()
+    # Classify each email address once, rather than every time we need to know
+    meta['isStaff'] = [StaffEmail(email) for email in meta.index]
+    meta['isUniversityStudent'] = [UniversityStudentEmail(email) for email in meta.index]
+    staffEmails = meta.index[meta['isStaff']]
 
 
     ################################################################################################
     ### Useful utility routine to spot who we have failed to match up to a Glasgow email address ###
     ################################################################################################
-    for email in sorted(emails):
-        entry = emails[email]
-
-        if (not StaffEmail(email)) and (not UniversityStudentEmail(email)):
-            firstEntry = next(iter(entry.values()))
-            print("NOTE: student {0}, {1} not matched to university email address".format(firstEntry[0], firstEntry[1]))
-            # Try and be helpful by seeing if we can find a match for the surname in an entry that *does* have a GU email address
-            possibleSurname = firstEntry[0].split(' ')[-1]
-            for email2 in sorted(emails):
-                if UniversityStudentEmail(email2):
-                    for date in emails[email2]:
-                        thisEntry = emails[email2][date]
-                        thisName = thisEntry[0]
-                        if possibleSurname in thisName:
-                            print(" Might match to {0}, {1}?".format(thisEntry[0], thisEntry[1]))
-                            print(" If so, manually add table row \"{0}\": \"{1}\",".format(firstEntry[1], thisEntry[1]))
-                            break
+    # Index the university students by each word in their name, so we can look up possible surname matches
+    surnameIndex = defaultdict(list)
+    for email, student in meta[meta['isUniversityStudent']].iterrows():
+        for word in set(student['name'].lower().split()):
+            surnameIndex[word].append((student['name'], email))
+
+    for email, firstEntry in meta[~meta['isStaff'] & ~meta['isUniversityStudent']].iterrows():
+        print("NOTE: student {0}, {1} not matched to university email address".format(firstEntry['name'], firstEntry['email']))
+        # Try and be helpful by seeing if we can find a match for the surname in an entry that *does* have a GU email address
+        possibleSurname = firstEntry['name'].split(' ')[-1]
+        for (name2, email2) in surnameIndex.get(possibleSurname.lower(), []):
+            print(" Might match to {0}, {1}?".format(name2, email2))
+            print(" If so, manually add table row \"{0}\": \"{1}\",".format(firstEntry['email'], email2))
 
     #####################################################
     ### Generate the attendance list for all students ###
@@ -220,108 +220,65 @@ for sourcePath in directoriesToProcess:
     # Also generates warnings about low-attending students
     # who have attended <= the specified minimum number of sessions.
     outputStudentAttendanceOnly = True
+    # Students to leave out of all the reports
+    excludedEmails = staffEmails if outputStudentAttendanceOnly else []
+
+    # Write out data to meeting report (agg is already sorted by student and then by date)
+    attendanceList = agg[~agg['key'].isin(excludedEmails)]
+    attendanceList[['name', 'email', 'start', 'mins']].to_csv("{0}/meeting-report.csv".format(sourcePath),
+                                                              index=False, header=False, chunksize=10000)
 
-    with open("{0}/meeting-report.csv".format(sourcePath), mode='w') as csvOutput:
-        csvwriter = csv.writer(csvOutput, delimiter=',')
-        for email in sorted(emails):
-            if outputStudentAttendanceOnly and StaffEmail(email):
-                continue
-                
-            entry = emails[email]
-
-            # Write out data to meeting report
-            for date in sorted(entry):
-                row = entry[date]
-                #print('{0}, {1}, {2}, {3}'.format(row[0], row[1], row[2], row[3]))
-                csvwriter.writerow(row)
-            # Monitor low-attending students
-            if (not StaffEmail(email)) and (len(entry) <= warningThreshold):
-                print("WARNING: student {0} {1} only attended {2} sessions".format(row[0], row[1], len(entry)))
+    # Monitor low-attending students (reporting the name and email from their most recent session)
+    sessions = agg.groupby('key', sort=False, observed=True).agg(name=('name', 'last'), email=('email', 'last'), count=('mins', 'size'))
+    lowAttendance = sessions[(sessions['count'] <= warningThreshold) & ~sessions.index.isin(staffEmails)]
+    for email, row in lowAttendance.iterrows():
+        print("WARNING: student {0} {1} only attended {2} sessions".format(row['name'], row['email'], row['count']))
 
     ########################################################
     ### Generate table of student name vs dates attended ###
     ########################################################
-
-    # First identify all the meeting dates
-    dateCatalogue = dict()
-    for email in sorted(emails):
-        entry = emails[email]
-        for date in entry:
-            if not date in dateCatalogue:
-                dateCatalogue[date] = date
-
-    # Now build up our table
-    with open("{0}/meeting-report-by-date.csv".format(sourcePath), mode='w') as csvOutput:
-        csvwriter = csv.writer(csvOutput, delimiter=',')
-        outputRow = ["Name", "Email"]
-        for date in sorted(dateCatalogue):
-            outputRow.append(date)
-        csvwriter.writerow(outputRow)
-        
-        for email in sorted(emails):
-            if outputStudentAttendanceOnly and StaffEmail(email):
-                continue
-                
-            studentRecord = emails[email]
-            firstEntry = next(iter(studentRecord.values()))
-            name = firstEntry[0]
-
-            # Write out row to meeting report
-            outputRow = [name, email]
-            for date in sorted(dateCatalogue):
-                if date in studentRecord:
-                    row = studentRecord[date]
-                    outputRow.append(row[3])
-                else:
-                    outputRow.append("")
-            csvwriter.writerow(outputRow)
+    WriteAttendanceTable(agg, 'date', meta, excludedEmails, "{0}/meeting-report-by-date.csv".format(sourcePath))
 
     ########################################################
     ### Generate table of student name vs weeks attended ###
     ########################################################
+    # Each column is labelled by the date of the Monday of that week.
+    # Sorting by that date (rather than by week-of-the-year) deals with the january wraparound to week #1.
+    # Entries that only have a filename as their date (3-column zoom reports) cannot be assigned to a week, and are left out.
+    WriteAttendanceTable(agg, 'weekStart', meta, excludedEmails, "{0}/meeting-report-by-week.csv".format(sourcePath))
+
+
+def main():
+    directoriesToProcess = []
+    dateFormat = '%d/%m/%Y %H:%M:%S %p'
+    warningThreshold = 0
+    processDefaultDirectory = True
+    for arg in sys.argv[1:]:
+        if arg.startswith("-m"):
+            if (len(arg) == 2):
+                print("Usage: rerun with e.g. \"-m4\" to warn for students who have attended <=4 sessions")
+            else:
+                print("Will warn for students who have attended <={0} sessions".format(arg[2:]))
+                warningThreshold = int(arg[2:])
+        elif arg == "-am":
+            print("Will expect american date formats")
+            dateFormat = '%m/%d/%Y %H:%M:%S %p'
+        else:
+            processDefaultDirectory = False
+            if "*" in arg:
+                print("Warning: ignoring quoted wildcard was passed in as a command line parameter \"{0}\".".format(arg))
+                print("  That approach is not supported - use an unquoted wildcard if you want to process a batch of directories independently")
+            else:
+                directoriesToProcess.append(arg)
+
+    if processDefaultDirectory:
+        print("No directories specified in command line arguments specified - processing current directory")
+        directoriesToProcess = ["."]
+
+    for sourcePath in directoriesToProcess:
+        ProcessDirectory(sourcePath, dateFormat, warningThreshold)
+
 
-    # First identify all the meeting weeks
-    weekCatalogue = dict()
-    for email in sorted(emails):
-        entry = emails[email]
-        for date in entry:
-            week = date.isocalendar()[1]
-            if not week in weekCatalogue:
-                weekStart = date_from_isoweek(date.isocalendar()[0],
-                                              date.isocalendar()[1],
-                                              1)
-                weekCatalogue[week] = weekStart
-
-    # Now build up our table
-    # To deal with the january wraparound to week #1, we need to use a construction like this
-    # to ensure we actually sort our week-date dictionary by calendar date, not week-of-the-year
-    #     for (weekNum,date) in sorted(weekCatalogue.items(), key=lambda kv: kv[1]):
-    with open("{0}/meeting-report-by-week.csv".format(sourcePath), mode='w') as csvOutput:
-        csvwriter = csv.writer(csvOutput, delimiter=',')
-        outputRow = ["Name", "Email"]
-        for (weekNum,date) in sorted(weekCatalogue.items(), key=lambda kv: kv[1]):
-            outputRow.append(weekCatalogue[weekNum])
-        csvwriter.writerow(outputRow)
-        
-        for email in sorted(emails):
-            if outputStudentAttendanceOnly and StaffEmail(email):
-                continue
-                
-            studentRecord = emails[email]
-            firstEntry = next(iter(studentRecord.values()))
-            name = firstEntry[0]
-
-            # Write out row to meeting report
-            outputRow = [name, email]
-            for (weekNum,date) in sorted(weekCatalogue.items(), key=lambda kv: kv[1]):
-                print(weekNum)
-                attendanceSum = 0
-                for date in studentRecord:
-                    studentEntryWeek = date.isocalendar()[1]
-                    if (studentEntryWeek == weekNum):
-                        attendanceSum += studentRecord[date][3]
-                if (attendanceSum > 0):
-                    outputRow.append(attendanceSum)
-                else:
-                    outputRow.append("")
-            csvwriter.writerow(outputRow)
+# Guarded, because the worker processes that load the files need to be able to import this script without running it
+if __name__ == "__main__":
+    main()